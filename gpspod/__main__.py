@@ -22,27 +22,30 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from . import protocol
-from . import output
-from . import pmem
-from . import interact
-from . import device
-from . import debug
 import argparse
 import time
 import datetime
 import sys
 import os
+import stat
+
+# Formats a datetime into the timestamp used in file names, like strftime with
+# %Y_%m_%d__%H_%M_%S but without parsing the format for every name.
+file_time_format = ("{0.year:04d}_{0.month:02d}_{0.day:02d}__"
+                    "{0.hour:02d}_{0.minute:02d}_{0.second:02d}")
 
 
 def get_communicator(args):
+    from . import interact
     if (args.recordfile is None):
-        recordpath = time.strftime("%Y_%m_%d__%H_%M_%S.json.gz")
+        recordpath = file_time_format.format(
+            datetime.datetime.now()) + ".json.gz"
     else:
         recordpath = args.recordfile
 
     if (args.playbackfile is not None):
-        entries = debug.load_json_usb(args.playbackfile)
+        from .debug import load_json_usb
+        entries = load_json_usb(args.playbackfile)
         return interact.OfflineCommunicator(entries)
 
     if (args.fs is not None):
@@ -57,44 +60,53 @@ def get_communicator(args):
 
 
 def get_device(args, communicator):
+    from . import device
+    import mmap
     if (args.fs is not None):
-        # load it
+        # map it, only the parts that are used are read from the file.
         with open(args.fs, "rb") as f:
-            fs = f.read()
+            fs = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
     else:
         fs = None
-    gps = device.GpsPod(communicator)
+    gps = device.GpsPod(communicator, pipeline_depth=args.pipeline_depth)
     gps.mount(fs)
     return gps
 
 
-def run_device_info(args):
-    communicator = get_communicator(args)
-    with communicator:
-        request = protocol.DeviceInfoRequest()
-        communicator.write_msg(request)
-        print(communicator.read_msg().body)
+# Commands that send a single request and print the body of the reply.
+# The request is named, such that the protocol is only imported when used.
+single_commands = {
+    "info": ("DeviceInfoRequest", "Print device info."),
+    "status": ("DeviceStatusRequest", "Print device status."),
+}
 
 
-def run_device_status(args):
+def run_single_command(args):
+    from . import protocol
+    request_name, _ = single_commands[args.command]
     communicator = get_communicator(args)
-    request = protocol.DeviceStatusRequest()
     with communicator:
-        communicator.write_msg(request)
+        communicator.write_msg(getattr(protocol, request_name)())
         print(communicator.read_msg().body)
 
 
+def print_tracks(tracklist):
+    # Print the listing with a single write instead of a write per track.
+    print("".join("{: >2d}: {}\n".format(i, track.get_header())
+                  for i, track in enumerate(tracklist)), end="")
+
+
 def run_show_tracks(args):
     communicator = get_communicator(args)
     gps = get_device(args, communicator)
     with communicator:
         gps.load_tracks()
         tracklist = gps.get_tracks()
-        for i in range(len(tracklist)):
-            print("{: >2d}: {}".format(i, tracklist[i].get_header()))
+        print_tracks(tracklist)
 
 
 def run_sgee(args):
+    from . import protocol
     if (args.file):
         with open(args.file, "rb") as f:
             data = f.read()
@@ -122,6 +134,7 @@ def run_sgee(args):
 
 
 def run_set_time(args):
+    from . import protocol
     try:
         current = datetime.datetime.now()
         new = datetime.datetime(
@@ -131,7 +144,7 @@ def run_set_time(args):
                 hour=args.hour if args.hour else current.hour,
                 minute=args.minute if args.minute else current.minute,
                 second=args.second if args.second else current.second)
-    except interact.CommunicatorError as e:
+    except ValueError as e:
         print("Error: {}, exiting".format(e))
         sys.exit(1)
     comm = get_communicator(args)
@@ -150,21 +163,27 @@ def run_set_time(args):
         comm.write_msg(request)
         if (type(comm.read_msg()) != protocol.SetTimeReply):
             print("Wrong response to set_time message.")
-            raise BaseError("Quitting, but with grace so the log is"
-                            "stored.")
+            # Quitting, but with grace so the log is stored.
+            sys.exit(1)
         print("Time should be set to {}.".format(time_str))
 
 
+# The accepted spellings of on and off states.
+true_states = frozenset(("1", "true", "on"))
+false_states = frozenset(("0", "false", "off"))
+
+
 def run_set_sounds(args):
-    request = protocol.SetSettingsRequest()
+    from . import protocol
     if (args.state != ""):
-        if (args.state in ["1", "true", "on"]):
-            request.sounds = True
-        elif (args.state in ["0", "false", "off"]):
-            request.sounds = False
+        if (args.state in true_states):
+            sounds = True
+        elif (args.state in false_states):
+            sounds = False
         else:
             print("State should be 0/1, true/false, on/off")
             sys.exit(1)
+        request = protocol.SetSettingsRequest(sounds=sounds)
     communicator = get_communicator(args)
     with communicator:
         if (args.state != ""):
@@ -182,70 +201,122 @@ def run_set_sounds(args):
 
 
 def run_settings(args):
+    from . import protocol
     if (args.write):
         # alpha
         # setlogparam
         # bravo
-        request = protocol.SetLogSettingsRequest()
-        if (args.autostart in ["1", "true", "on"]):
-            request.autostart = True
-        elif (args.autostart in ["0", "false", "off"]):
-            request.autostart = False
+        if (args.autostart in true_states):
+            autostart = True
+        elif (args.autostart in false_states):
+            autostart = False
         else:
             print("Autostart should be 0/1, true/false, on/off, exiting.")
             sys.exit(1)
 
-        if (args.autosleep not in [0, 10, 30, 60]):
-            print("Autosleep should be 0, 10, 30 or 60, exiting.")
-            sys.exit(1)
-
-        if (args.interval not in [1, 60]):
-            print("Interval should be 1 or 60, exiting.")
-            sys.exit(1)
+        # Autosleep and interval are restricted by their argument choices.
         if ((args.autolap < 0) or (args.autolap > 2**16)):
             print("Autolap should be in 0-65536 (perhaps 2**32? needs test.).")
             sys.exit(1)
 
-        request.autolap = args.autolap
-        request.autosleep = args.autosleep
-        request.interval = args.interval
+        request = protocol.SetLogSettingsRequest(autostart=autostart,
+                                                 autolap=args.autolap,
+                                                 autosleep=args.autosleep,
+                                                 interval=args.interval)
 
     comm = get_communicator(args)
     gps = get_device(args, comm)
     if (args.write):
+        # The device only accepts each step after the previous one is
+        # replied to, so these are sent one at a time.
+        steps = [
+            (protocol.SetUnknownRequestAlpha(), protocol.SetUnknownReplyAlpha,
+             "Wrong response in preparing to send the settings."),
+            (request, protocol.SetLogSettingsReply,
+             "Wrong response to write settings..."),
+            (protocol.SetUnknownRequestBravo(), protocol.SetUnknownReplyBravo,
+             "Wrong response in finishing settings procedure."),
+        ]
         with comm:
-            comm.write_msg(protocol.SetUnknownRequestAlpha())
-            if (type(comm.read_msg()) != protocol.SetUnknownReplyAlpha):
-                print("Wrong response in preparing to send the settings.")
-                raise BaseError("Quitting, but with grace so the log is"
-                                "stored.")
-            comm.write_msg(request)
-            if (type(comm.read_msg()) != protocol.SetLogSettingsReply):
-                print("Wrong response to write settings...")
-                raise BaseError("Quitting, but with grace so the log is"
-                                "stored.")
-            comm.write_msg(protocol.SetUnknownRequestBravo())
-            if (type(comm.read_msg()) != protocol.SetUnknownReplyBravo):
-                print("Wrong response in finishing settings procedure.")
-                raise BaseError("Quitting, but with grace so the log is"
-                                "stored.")
+            for step_request, reply_type, error in steps:
+                comm.write_msg(step_request)
+                if (type(comm.read_msg()) != reply_type):
+                    print(error)
+                    # Quitting, but with grace so the log is stored.
+                    sys.exit(1)
             print("Settings should be {}".format(request.set_settings_request))
     else:
         with comm:
             print(gps.get_settings())
 
 
+def write_atomically(output_path, write):
+    # Write to a partial file next to the output and rename it over the output
+    # once complete, an interrupted write leaves the old file intact. Returns
+    # what write returns.
+    # lstat does not follow symlinks, a symlink is not replaced either.
+    try:
+        is_regular = stat.S_ISREG(os.lstat(output_path).st_mode)
+    except FileNotFoundError:
+        is_regular = True
+    if (not is_regular):
+        # Symlinks, devices and pipes like /dev/stdout can't be replaced,
+        # write to them.
+        with open(output_path, "wb", buffering=1 << 20) as f:
+            return write(f)
+
+    partial_path = output_path + ".partial"
+    try:
+        with open(partial_path, "wb", buffering=1 << 20) as f:
+            result = write(f)
+            f.flush()
+            os.fsync(f.fileno())
+            # The file is not read again, its pages do not have to stay
+            # cached.
+            if (hasattr(os, "posix_fadvise")):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        os.replace(partial_path, output_path)
+    except BaseException:
+        # Don't leave the partial file behind.
+        try:
+            os.unlink(partial_path)
+        except OSError:
+            pass
+        raise
+    return result
+
+
+def write_gpx(logwriter, output_path):
+    return write_atomically(output_path, logwriter.write_xml)
+
+
+def report_gpx(pending):
+    future, output_path = pending
+    print("Done creating gpx, wrote {} bytes to {}.".format(future.result(),
+          output_path))
+
+
+def parse_track_index(value):
+    # Rejects invalid indices before the device is opened.
+    index = int(value)
+    if (index < -1):
+        raise argparse.ArgumentTypeError(
+            "track index should be -1 or larger: {}".format(value))
+    return index
+
+
 def run_retrieve_tracks(args):
+    from . import output
+    import concurrent.futures
     communicator = get_communicator(args)
     gps = get_device(args, communicator)
     with communicator:
         gps.load_tracks()
         tracklist = gps.get_tracks()
-        for i in range(len(tracklist)):
-            print("{: >2d}: {}".format(i, tracklist[i].get_header()))
+        print_tracks(tracklist)
 
-        if (not args.recover) and (args.index >= len(tracklist) and
-                                   (args.index != -1)):
+        # The index is -1 or larger, its upper bound is only known now.
+        if ((not args.recover) and (args.index >= len(tracklist))):
             print("The track index is out of range.")
             print("Valid track range is: 0-{}".format(len(tracklist)-1))
             sys.exit(1)
@@ -254,18 +325,35 @@ def run_retrieve_tracks(args):
             print("Track index is -1, retrieval all tracks.")
 
         if args.recover:
-            tracks = [gps.recovered_track()]
+            recovered = gps.recovered_track()
             args.local_time = True
-            if (not track):
+            if (not recovered):
                 print("Could not recover anything.")
                 sys.exit(1)
             else:
                 print("Succesfully recovered track! Resuming default process.")
-        if (args.index == -1):
+            # The recovered track comes after the existing tracks.
+            tracks = [(len(tracklist), recovered)]
+        elif (args.index == -1):
             tracks = enumerate(tracklist)
         else:
             tracks = [(args.index, tracklist[args.index])]
 
+        if args.override_time:
+            current = datetime.datetime.now()
+            for field in ("year", "month", "day", "hour", "minute", "second"):
+                if (getattr(args, field) is None):
+                    setattr(args, field, getattr(current, field))
+            try:
+                datetime.datetime(year=args.year, month=args.month,
+                                  day=args.day, hour=args.hour,
+                                  minute=args.minute, second=args.second)
+            except ValueError as e:
+                print("Error: {}, exiting".format(e))
+                sys.exit(1)
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        pending = None
         for track_index, track in tracks:
             metadata = track.get_header()
 
@@ -277,15 +365,10 @@ def run_retrieve_tracks(args):
                 metadata.minute = args.minute
                 metadata.second = args.second
 
-            base_time = datetime.datetime(year=metadata.year,
-                                          month=metadata.month,
-                                          day=metadata.day,
-                                          hour=metadata.hour,
-                                          minute=metadata.minute,
-                                          second=metadata.second)
             if (args.outfile is None):
-                output_path = base_time.strftime(
-                    "track_%Y_%m_%d__%H_%M_%S.gpx")
+                # The header has the date fields the file name is made of.
+                output_path = ("track_" +
+                               file_time_format.format(metadata) + ".gpx")
                 if (args.recover):
                     output_path = "recovered_" + output_path
             else:
@@ -314,23 +397,40 @@ def run_retrieve_tracks(args):
                                          lap_adds_wpt=add_wpt,
                                          write_points=all_points,
                                          time_local=args.local_time)
-            text = logwriter.create_xml()
-
-            with open(output_path, "wb") as f:
-                f.write(text)
+            # Create and write the gpx on the worker, such that the entries of
+            # the next track can be retrieved from the device meanwhile.
+            if (pending is not None):
+                report_gpx(pending)
+            pending = (executor.submit(write_gpx, logwriter, output_path),
+                       output_path)
 
-            print("Done creating gpx, wrote {} bytes to {}.".format(len(text),
-                  output_path))
+        if (pending is not None):
+            report_gpx(pending)
+        executor.shutdown()
 
 
 def run_dump_fs(args):
+    from . import pmem
+    from . import protocol
     communicator = get_communicator(args)
     gps = get_device(args, communicator)
-    with communicator:
-        data = gps[0:pmem.FILESYSTEM_SIZE]
+    # Write the dump in chunks as it is retrieved, instead of holding on to
+    # the entire filesystem before writing it.
+    chunk_size = 256 * protocol.DataRequest.block_size
+    # Progress is shown once per chunk, not for every block. It goes to
+    # stderr, such that dumping to /dev/stdout gives just the filesystem.
+    progress = "Retrieved 0x{{:0>6X}}/0x{:0>6X}\r".format(pmem.FILESYSTEM_SIZE)
+
+    def write(f):
+        for start in range(0, pmem.FILESYSTEM_SIZE, chunk_size):
+            f.write(gps.view(slice(start, start + chunk_size)))
+            sys.stderr.write(progress.format(
+                min(start + chunk_size, pmem.FILESYSTEM_SIZE)))
+            sys.stderr.flush()
+        print("", file=sys.stderr)
 
-    with open(args.file, "bw") as f:
-        f.write(data)
+    with communicator:
+        write_atomically(args.file, write)
 
 
 def run_debug_reconstruct_fs(args):
@@ -359,16 +459,17 @@ def run_debug_internallog(args):
         logs = gps.get_debug_logs()
         for log in logs:
             log.load_entries()
-            for m in log.get_entries():
-                print(m)
+            # Write the entries of a log at once, not with a write per entry.
+            print("".join("{}\n".format(m) for m in log.get_entries()),
+                  end="")
 
 
 def run_debug_df(args):
     import ctypes
+    import collections
     communicator = get_communicator(args)
     gps = get_device(args, communicator)
     with communicator:
-        gps = get_device(args, communicator)
         track_block_size = gps.data.tracks.size
         # track block has offset from the file, file has offset as well.
         # lets just print some estimates.
@@ -379,8 +480,7 @@ def run_debug_df(args):
         block_header = gps.data.tracks.header
         print("Block header: {}".format(block_header))
         tracklist = gps.get_tracks()
-        for i in range(len(tracklist)):
-            track = tracklist[i]
+        for i, track in enumerate(tracklist):
             # track.get_header()
             track_start = track.orig_pos
             track.load_entries()
@@ -393,24 +493,24 @@ def run_debug_df(args):
                                              track_size / track_block_size))
 
             print("  Track {}".format(str(track.get_header())))
-            stats = {"sizes": {}}
+            stats = collections.Counter()
+            # The first entry of each type, to determine the size of the type.
+            first_entries = {}
             last_with_time = None
             for k in track.get_entries():
                 n = k.__class__.__name__
-                if (n not in stats):
-                    stats[n] = 0
-                    stats["sizes"][n] = ctypes.sizeof(k)
                 stats[n] += 1
+                first_entries.setdefault(n, k)
                 x = dict(k)
                 if ("time" in x):
                     last_with_time = x
-            for n in stats["sizes"]:
-                field_size = stats["sizes"][n]
+            for n in stats:
+                field_size = ctypes.sizeof(first_entries[n])
                 print("  {: <40s} ({: >4d}b): {: >5d}  total: {: >8d}b, "
                       "{: >3.2f}".format(n, field_size, stats[n],
                                          stats[n] * field_size,
                                          stats[n] * field_size / track_size))
-            total_samples = sum([stats[n] for n in stats["sizes"]])
+            total_samples = sum(stats.values())
             print("  {: <40s} ({: >4d}b): {: >5d}  total: {: >8d}b, "
                   "{: >3.2f}".format("Entry length <H for all samples: ", 2,
                                      total_samples, total_samples * 2,
@@ -419,8 +519,8 @@ def run_debug_df(args):
                   "{: >3.2f}".format("Type <B for log samples: ", 1,
                                      total_samples, total_samples * 1,
                                      total_samples * 1.0 / track_size))
-            episodic_count = sum([stats[n] for n in stats["sizes"] if
-                                  n != "SpecifiedPeriodicStructure"])
+            episodic_count = (total_samples -
+                              stats["SpecifiedPeriodicStructure"])
             print("  {: <40s} ({: >4d}b): {: >5d}  total: {: >8d}b, "
                   "{: >3.2f}".format("I and B for episodic data: ", 5,
                                      episodic_count, episodic_count * 5,
@@ -477,40 +577,22 @@ parser.add_argument('--read-sleep-duration',
                          "(environ GPSPOD_READ_SLEEP_DURATION) [" + read_sleep_duration_str + "%(default)s ms]",
                     default=read_sleep_duration_val, type=float)
 
+pipeline_depth_str, pipeline_depth_val = retrieve_environment("GPSPOD_PIPELINE_DEPTH", int, 1)
+parser.add_argument('--pipeline-depth',
+                    help="Number of data requests to send before reading the replies. "
+                         "(environ GPSPOD_PIPELINE_DEPTH) [" + pipeline_depth_str + "%(default)s requests]",
+                    default=pipeline_depth_val, type=int)
+
 subparsers = parser.add_subparsers(dest="command")
 
 
-device_info = subparsers.add_parser("info", help="Print device info.")
-device_info.set_defaults(func=run_device_info)
-device_status = subparsers.add_parser("status", help="Print device status.")
-device_status.set_defaults(func=run_device_status)
+for name, (request_name, help_text) in single_commands.items():
+    single_command = subparsers.add_parser(name, help=help_text)
+    single_command.set_defaults(func=run_single_command)
 
 show_tracks = subparsers.add_parser("tracks", help="Show available tracks.")
 show_tracks.set_defaults(func=run_show_tracks)
 
-retrieve_tracks = subparsers.add_parser(
-    "retrieve", help="Retrieve a track.",
-    epilog="A lap event is either caused by the autolap value or by the user"
-           "pressing the button once.")
-
-retrieve_tracks.add_argument('index', type=int,
-                             help='The index of the track to download. You '
-                             'can specify -1 to retrieve all tracks.')
-retrieve_tracks.add_argument('outfile', type=str, default=None, nargs="?",
-                             help='The output file for FS, defaults to: '
-                             'track_%%Y_%%m_%%d__%%H_%%M_%%S.gpx.')
-retrieve_tracks.add_argument('--no-lap-splits-segment', default=False,
-                             action="store_true",
-                             help='Do not split the segments on a lap event.')
-retrieve_tracks.add_argument('--no-lap-adds-wpt', default=False,
-                             action="store_true",
-                             help='Do not add a wpt entry for a lap event.')
-retrieve_tracks.add_argument('--no-write-points', default=False,
-                             action="store_true",
-                             help='Do not write all points, only lap events.')
-retrieve_tracks.add_argument('--local-time', default=False,
-                             action="store_true",
-                             help='Use local time instead of UTC for points.')
 
 recover_help = """ Attempt to recover GPS data that is NOT part of tracks
 current on the device. Can be used to recover partial tracks when the header
@@ -532,123 +614,247 @@ python -m gpspod --fs dump_from_fs.bin retrieve
 
 When recovering, the 0 is a dummy and unused.
 """
-retrieve_tracks.add_argument('--recover', default=False, action="store_true",
-                             help=recover_help)
-current_time = datetime.datetime.now()
-retrieve_tracks.add_argument('--year', default=current_time.year, type=int)
-retrieve_tracks.add_argument('--month', default=current_time.month, type=int)
-retrieve_tracks.add_argument('--day', default=current_time.day, type=int)
-retrieve_tracks.add_argument('--hour', default=current_time.hour, type=int)
-retrieve_tracks.add_argument('--minute', default=current_time.minute, type=int)
-retrieve_tracks.add_argument('--second', default=current_time.second, type=int)
-
-retrieve_tracks.add_argument('--override-time', default=False,
-                             action="store_true", help="Override the log start"
-                             " time by this date and time.")
-
-retrieve_tracks.set_defaults(func=run_retrieve_tracks)
-
-set_sounds = subparsers.add_parser("sounds", help="Enable or disable sounds. "
-                                   "Call without arguments to show the current"
-                                   " sound state.")
-set_sounds.add_argument('state', type=str, default="", nargs="?",
-                        help='0/1, true/false, on/off...')
-set_sounds.set_defaults(func=run_set_sounds)
-
-
-settings = subparsers.add_parser("settings",
-                                 help="Sets the logging parameters. "
-                                 "Call without arguments to show the current"
-                                 " logging parameters.")
-settings.add_argument('--write', default=False, action="store_true",
-                      help="Write settings instead of showing them.")
-settings.add_argument('--autolap', type=int, default=0,
-                      help='Autolap distance in meters. (default: 0)')
-settings.add_argument('--autostart', type=str, default="on",
-                      help='Autostart logging after fix if (default: on)')
-settings.add_argument('--autosleep', type=int, default=0,
-                      help='Sleep after 10/30/60 minute idle (default: 0)')
-settings.add_argument('--interval', type=int, default=1,
-                      help='Set the logging interval 1s/60s (default: 1)')
-settings.set_defaults(func=run_settings)
-
-retrieve_fs = subparsers.add_parser(
-                "dump",
-                help="Dump all bytes from the filesystem to a file.",
-                epilog="Using this command is the best way to ensure all data "
-                       "is stored; if some data is present in the log, but not"
-                       " converted to GPX it will always be stored in the FS"
-                       " dump. However, the data is not read easily, which is"
-                       " why this tool has the --fs flag to do that for you.")
-retrieve_fs.add_argument('file',
-                         type=str, nargs="?",
-                         help='The file to write to, this value defaults to '
-                         'gpspod_dump_%%Y_%%m_%%d__%%H_%%M_%%S.fs',
-                         default=time.strftime("dump_%Y_%m_%d__%H_%M_%S.fs"))
-retrieve_fs.set_defaults(func=run_dump_fs)
-
-
-set_time = subparsers.add_parser("settime",
-                                 help="Set the local time in the device. "
-                                 "When arguments are missing the values the "
-                                 "local time is used.")
-set_time.add_argument('--year', default=None, type=int,
-                      help='The year to set.')
-set_time.add_argument('--month', default=None, type=int,
-                      help='The month to set.')
-set_time.add_argument('--day', default=None, type=int,
-                      help='The day to set.')
-set_time.add_argument('--hour', default=None, type=int,
-                      help='The hour to set.')
-set_time.add_argument('--minute', default=None, type=int,
-                      help='The minute to set.')
-set_time.add_argument('--second', default=None, type=int,
-                      help='The second to set.')
-set_time.set_defaults(func=run_set_time)
-
-sgee = subparsers.add_parser("sgee",
-                             help="Upload SGEE data or show last upload time.")
-sgee.add_argument('file', default=None, type=str, nargs="?",
-                  help='The file with SGEE data to write to the device.')
-sgee.set_defaults(func=run_sgee)
-
-
-# create subparser for debug
-debug_command = subparsers.add_parser("debug", help="Various debug tools.")
-
-debug_subcommand = debug_command.add_subparsers(dest="subcommand")
-
-debug_view_messages = debug_subcommand.add_parser(
+
+
+def add_retrieve_command(subparsers):
+    retrieve_tracks = subparsers.add_parser(
+        "retrieve", help="Retrieve a track.",
+        epilog="A lap event is either caused by the autolap value or by the "
+               "user pressing the button once.")
+
+    retrieve_tracks.add_argument('index', type=parse_track_index,
+                                 help='The index of the track to download. '
+                                 'You can specify -1 to retrieve all tracks.')
+    retrieve_tracks.add_argument('outfile', type=str, default=None, nargs="?",
+                                 help='The output file for FS, defaults to: '
+                                 'track_%%Y_%%m_%%d__%%H_%%M_%%S.gpx.')
+    retrieve_tracks.add_argument('--no-lap-splits-segment', default=False,
+                                 action="store_true",
+                                 help='Do not split the segments on a lap '
+                                 'event.')
+    retrieve_tracks.add_argument('--no-lap-adds-wpt', default=False,
+                                 action="store_true",
+                                 help='Do not add a wpt entry for a lap '
+                                 'event.')
+    retrieve_tracks.add_argument('--no-write-points', default=False,
+                                 action="store_true",
+                                 help='Do not write all points, only lap '
+                                 'events.')
+    retrieve_tracks.add_argument('--local-time', default=False,
+                                 action="store_true",
+                                 help='Use local time instead of UTC for '
+                                 'points.')
+
+    retrieve_tracks.add_argument('--recover', default=False,
+                                 action="store_true", help=recover_help)
+    # Unset fields default to the current time, see run_retrieve_tracks.
+    retrieve_tracks.add_argument('--year', default=None, type=int)
+    retrieve_tracks.add_argument('--month', default=None, type=int)
+    retrieve_tracks.add_argument('--day', default=None, type=int)
+    retrieve_tracks.add_argument('--hour', default=None, type=int)
+    retrieve_tracks.add_argument('--minute', default=None, type=int)
+    retrieve_tracks.add_argument('--second', default=None, type=int)
+
+    retrieve_tracks.add_argument('--override-time', default=False,
+                                 action="store_true", help="Override the log "
+                                 "start time by this date and time.")
+
+    retrieve_tracks.set_defaults(func=run_retrieve_tracks)
+    return retrieve_tracks
+
+
+def add_sounds_command(subparsers):
+    set_sounds = subparsers.add_parser("sounds",
+                                       help="Enable or disable sounds. "
+                                       "Call without arguments to show the "
+                                       "current sound state.")
+    set_sounds.add_argument('state', type=str, default="", nargs="?",
+                            help='0/1, true/false, on/off...')
+    set_sounds.set_defaults(func=run_set_sounds)
+    return set_sounds
+
+
+def add_settings_command(subparsers):
+    settings = subparsers.add_parser("settings",
+                                     help="Sets the logging parameters. "
+                                     "Call without arguments to show the "
+                                     "current logging parameters.")
+    settings.add_argument('--write', default=False, action="store_true",
+                          help="Write settings instead of showing them.")
+    settings.add_argument('--autolap', type=int, default=0,
+                          help='Autolap distance in meters. (default: 0)')
+    settings.add_argument('--autostart', type=str, default="on",
+                          help='Autostart logging after fix if (default: on)')
+    settings.add_argument('--autosleep', type=int, default=0,
+                          choices=(0, 10, 30, 60),
+                          help='Sleep after 10/30/60 minute idle (default: 0)')
+    settings.add_argument('--interval', type=int, default=1, choices=(1, 60),
+                          help='Set the logging interval 1s/60s (default: 1)')
+    settings.set_defaults(func=run_settings)
+    return settings
+
+
+def add_dump_command(subparsers):
+    retrieve_fs = subparsers.add_parser(
+                    "dump",
+                    help="Dump all bytes from the filesystem to a file.",
+                    epilog="Using this command is the best way to ensure all "
+                           "data is stored; if some data is present in the "
+                           "log, but not converted to GPX it will always be "
+                           "stored in the FS dump. However, the data is not "
+                           "read easily, which is why this tool has the --fs "
+                           "flag to do that for you.")
+    retrieve_fs.add_argument('file',
+                             type=str, nargs="?",
+                             help='The file to write to, this value defaults '
+                             'to gpspod_dump_%%Y_%%m_%%d__%%H_%%M_%%S.fs',
+                             default="dump_" + file_time_format.format(
+                                datetime.datetime.now()) + ".fs")
+    retrieve_fs.set_defaults(func=run_dump_fs)
+    return retrieve_fs
+
+
+def add_settime_command(subparsers):
+    set_time = subparsers.add_parser("settime",
+                                     help="Set the local time in the device. "
+                                     "When arguments are missing the values "
+                                     "the local time is used.")
+    set_time.add_argument('--year', default=None, type=int,
+                          help='The year to set.')
+    set_time.add_argument('--month', default=None, type=int,
+                          help='The month to set.')
+    set_time.add_argument('--day', default=None, type=int,
+                          help='The day to set.')
+    set_time.add_argument('--hour', default=None, type=int,
+                          help='The hour to set.')
+    set_time.add_argument('--minute', default=None, type=int,
+                          help='The minute to set.')
+    set_time.add_argument('--second', default=None, type=int,
+                          help='The second to set.')
+    set_time.set_defaults(func=run_set_time)
+    return set_time
+
+
+def add_sgee_command(subparsers):
+    sgee = subparsers.add_parser("sgee",
+                                 help="Upload SGEE data or show last upload "
+                                 "time.")
+    sgee.add_argument('file', default=None, type=str, nargs="?",
+                      help='The file with SGEE data to write to the device.')
+    sgee.set_defaults(func=run_sgee)
+    return sgee
+
+
+def add_named_subcommands(parser, subparsers, builders, argv, nested=()):
+    # Only the subcommand named on the command line needs its parser, the
+    # builders are called with the subparsers to add to. The builders named in
+    # nested add subcommands of their own, they are also given the arguments
+    # that follow their name. Every name on the command line is added, an
+    # option value that equals a name only adds an unused parser. All of them
+    # are added if no subcommand is named or help is asked for before it, and
+    # the others are added when parser reports an error, such that the help
+    # and the errors list every subcommand. Returns the added parsers by name.
+    parsers = {}
+
+    def add(name, argv):
+        if (name in nested):
+            parsers[name] = builders[name](subparsers, argv)
+        else:
+            parsers[name] = builders[name](subparsers)
+
+    def add_all():
+        for name in builders:
+            if (name not in parsers):
+                add(name, [])
+
+    def error(message, error=parser.error):
+        add_all()
+        error(message)
+
+    for arg in argv:
+        if (arg in ("-h", "--help")):
+            break
+        if ((arg in subparsers.choices) or (arg in builders)):
+            for name in dict.fromkeys(a for a in argv if a in builders):
+                # The arguments after the first occurrence of a name include
+                # those after the occurrence that is the actual subcommand.
+                add(name, argv[argv.index(name) + 1:])
+            parser.error = error
+            return parsers
+    add_all()
+    return parsers
+
+
+def add_debug_command(subparsers, argv):
+    debug_command = subparsers.add_parser("debug",
+                                          help="Various debug tools.")
+    debug_subcommand = debug_command.add_subparsers(dest="subcommand")
+    add_named_subcommands(debug_command, debug_subcommand, debug_subcommands,
+                          argv)
+    return debug_command
+
+
+def add_view_command(debug_subcommand):
+    debug_view_messages = debug_subcommand.add_parser(
                         "view", help="Show messages stored in an file that "
                         "contains USB messages, either an PDML from wireshark "
                         "or a recording from this tool with --record.")
-debug_view_messages.add_argument('file', type=str,
-                                 help='The file with USB interaction.')
-debug_view_messages.set_defaults(func=run_debug_view_messages)
+    debug_view_messages.add_argument('file', type=str,
+                                     help='The file with USB interaction.')
+    debug_view_messages.set_defaults(func=run_debug_view_messages)
+    return debug_view_messages
 
 
-debug_reconstruct_fs = debug_subcommand.add_parser(
+def add_reconstruct_command(debug_subcommand):
+    debug_reconstruct_fs = debug_subcommand.add_parser(
                         "reconstruct",
                         help="Reconstruct filesystem from interaction.")
-debug_reconstruct_fs.add_argument('file',
-                                  type=str,
-                                  help='The file with transactions.')
-debug_reconstruct_fs.add_argument(
-                    'outfile', type=str, default=None, nargs="?",
-                    help='The output file for FS, defaults to: '
-                    'INPUTFILE.binfs')
-debug_reconstruct_fs.set_defaults(func=run_debug_reconstruct_fs)
-
-debug_internallog = debug_subcommand.add_parser(
+    debug_reconstruct_fs.add_argument('file',
+                                      type=str,
+                                      help='The file with transactions.')
+    debug_reconstruct_fs.add_argument(
+                        'outfile', type=str, default=None, nargs="?",
+                        help='The output file for FS, defaults to: '
+                        'INPUTFILE.binfs')
+    debug_reconstruct_fs.set_defaults(func=run_debug_reconstruct_fs)
+    return debug_reconstruct_fs
+
+
+def add_internallog_command(debug_subcommand):
+    debug_internallog = debug_subcommand.add_parser(
                         "internallog",
                         help="Print the internal diagnostics log kept on the "
                         "GPS, info such as time to fix, battery voltage, etc.")
-debug_internallog.set_defaults(func=run_debug_internallog)
+    debug_internallog.set_defaults(func=run_debug_internallog)
+    return debug_internallog
+
+
+def add_df_command(debug_subcommand):
+    debug_df = debug_subcommand.add_parser(
+                        "df", help="Some size metrics, run on dump.")
+    debug_df.set_defaults(func=run_debug_df)
+    return debug_df
+
+
+subcommands = {
+    "retrieve": add_retrieve_command,
+    "sounds": add_sounds_command,
+    "settings": add_settings_command,
+    "dump": add_dump_command,
+    "settime": add_settime_command,
+    "sgee": add_sgee_command,
+    "debug": add_debug_command,
+}
 
-debug_df = debug_subcommand.add_parser("df",
-                                       help="Some size metrics, run on dump.")
-debug_df.set_defaults(func=run_debug_df)
+debug_subcommands = {
+    "view": add_view_command,
+    "reconstruct": add_reconstruct_command,
+    "internallog": add_internallog_command,
+    "df": add_df_command,
+}
 
+command_parsers = add_named_subcommands(parser, subparsers, subcommands,
+                                        sys.argv[1:], nested=("debug",))
 
 # debug_dev_func = debug_subcommand.add_parser("test")
 # debug_dev_func.set_defaults(func=run_debug_dev_func)
@@ -667,8 +873,8 @@ if (args.command is None):
 # debug and no command.
 if (args.command == "debug"):
     if (args.subcommand is None):
-        debug_command.print_help()
-        debug_command.exit()
+        command_parsers["debug"].print_help()
+        command_parsers["debug"].exit()
         sys.exit(1)
 
 
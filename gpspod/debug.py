@@ -31,21 +31,55 @@ from . import pmem
 import pickle
 import json
 import gzip
-import base64
+import heapq
+import hashlib
+import binascii
+import operator
+import os
+import stat
+
+
+def load_cached(path, loader):
+    # Returns loader(path), which is cached in a pickle in the user's cache
+    # directory. The cache is named after a hash of the contents of path, a
+    # pickle that happens to sit next to path is never loaded.
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME") or
+                             os.path.expanduser("~/.cache"), "gpspod")
+    cache_path = os.path.join(cache_dir, digest.hexdigest() + ".pickle3")
+    if (os.path.isfile(cache_path)):
+        with open(cache_path, "rb") as f:
+            return pickle.load(f)
+
+    result = loader(path)
+    # write the cached version, reading a recording should still work when
+    # the cache can't be written. It is renamed into place once complete.
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_path + ".partial", "wb") as f:
+            pickle.dump(result, f)
+        os.replace(cache_path + ".partial", cache_path)
+    except OSError:
+        pass
+    return result
+
+
+def parse_pdml_usb(path):
+    conversation = USBPDML(path)
+    conversation.parse_file()
+    return conversation.interaction()
 
 
 def load_pdml_usb(path):
-    # check if we have a cached version available
+    # check if we were given the cached version directly.
     if (path.endswith(".pickle3")):
         with open(path, "rb") as f:
             interactions = pickle.load(f)
     else:
-        conversation = USBPDML(path)
-        conversation.parse_file()
-        interactions = conversation.interaction()
-        # write the cached version
-        with open(path + ".pickle3", "wb") as f:
-            pickle.dump(interactions, f)
+        interactions = load_cached(path, parse_pdml_usb)
 
     entries = {"incoming": [], "outgoing": []}
     start_time = None
@@ -69,32 +103,35 @@ def load_pdml_usb(path):
 
 
 def load_json_usb(path):
+    # The recording is ascii, it is parsed from bytes without decoding it to
+    # text first. Decoding it is fast enough that it is not cached.
     opener = gzip.open if path.endswith(".gz") else open
-    with opener(path, "rt") as f:
-        rawentries = json.load(f)
+    with opener(path, "rb") as f:
+        rawentries = json.loads(f.read())
 
-    entries = {"incoming": [], "outgoing": []}
-    for d in entries.keys():
-        for t, v in rawentries[d]:
-            entries[d].append((t, base64.b64decode(v)))
+    entries = {}
+    for d in ("incoming", "outgoing"):
+        entries[d] = [(t, binascii.a2b_base64(v)) for t, v in rawentries[d]]
 
     return entries
 
 
 def order_entries_and_combine(entries):
-    one_list = []
-    for d in entries.keys():
-        for z in entries[d]:
-            one_list.append((z[0], d, z[1]))
-    return sorted(one_list, key=lambda d: d[0])
+    # The entries of each direction are recorded in order, merging them keeps
+    # the combined entries in order without sorting. Returns an iterator.
+    def with_direction(d):
+        return ((t, d, v) for t, v in entries[d])
+    return heapq.merge(*[with_direction(d) for d in entries.keys()],
+                       key=operator.itemgetter(0))
 
 
 def load_usb_transactions(path):
-    if (path.count(".xml") != 0):
+    # Dispatch on the extension, a pdml capture may be given by its cache.
+    if (path.endswith((".xml", ".xml.pickle3"))):
         data = load_pdml_usb(path)
         return data
 
-    if (path.count(".json")):
+    if (path.endswith((".json", ".json.gz"))):
         data = load_json_usb(path)
         return data
 
@@ -104,34 +141,42 @@ def reconstruct_filesystem(path, output_file):
     fs_bytes = bytearray(pmem.FILESYSTEM_SIZE)
     touched_fs = bytearray(pmem.FILESYSTEM_SIZE)
     feed = USBPacketFeed()
+    data_reply = protocol.DataReply
     for t, v in data["incoming"]:
         usb_packet = USBPacket.read(v)
         res = feed.packet(usb_packet)
         if (res):
             msg = load_msg(res)
-            if (type(msg) == protocol.DataReply):
+            if (isinstance(msg, data_reply)):
                 pos = msg.position()
-                length = msg.length()
-                fs_bytes[pos:pos+length] = bytes(msg.content())
-                touched_fs[pos:pos+length] = bytearray(
-                                                [1 for i in range(length)])
-
-    missing = False
-    for i in range(len(touched_fs)):
-        v = touched_fs[i]
-        if (v == 0):
-            if (missing is False):
-                print("Missing from 0x{:0>4X}".format(i), end="")
-            missing = True
-        else:
-            if (missing is True):
-                print(" up to 0x{:0>4X}".format(i))
-            missing = False
-    if (missing is True):
-        print(" up to 0x{:0>4X}".format(i))
-
+                length = msg.content_into(
+                    memoryview(fs_bytes)[pos:pos+msg.length()])
+                touched_fs[pos:pos+length] = b"\x01" * length
+
+    # Find the boundaries of the untouched ranges instead of visiting every
+    # byte, a range that runs to the end is reported up to the last byte.
+    start = touched_fs.find(0)
+    while (start != -1):
+        end = touched_fs.find(1, start)
+        if (end == -1):
+            print("Missing from 0x{:0>4X} up to 0x{:0>4X}".format(
+                start, len(touched_fs) - 1))
+            break
+        print("Missing from 0x{:0>4X} up to 0x{:0>4X}".format(start, end))
+        start = touched_fs.find(0, end)
+
+    # A write larger than the buffer goes to the file directly, without
+    # copying the filesystem.
     with open(output_file, "wb") as f:
         f.write(fs_bytes)
+        # The filesystem is not read again, its pages do not have to stay
+        # cached. Only pages that were synced are dropped, pipes and devices
+        # like /dev/stdout can't be synced.
+        if (hasattr(os, "posix_fadvise") and
+                stat.S_ISREG(os.fstat(f.fileno()).st_mode)):
+            f.flush()
+            os.fsync(f.fileno())
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
 
 
 def print_interaction(path):
@@ -149,9 +194,11 @@ def print_interaction(path):
     data = load_usb_transactions(path)
     # lets just start with outgoing always.
     combined_entries = order_entries_and_combine(data)
-    start_time = combined_entries[0][0]
+    start_time = None
     packet_counter = 0
     for time, direction, data in combined_entries:
+        if (start_time is None):
+            start_time = time
         packet_counter += 1
         reltime = time - start_time
         usb_packet = USBPacket.read(data)
@@ -26,65 +26,194 @@ from . import pmem
 from . import protocol
 from . import interact
 import time
+import random
 import struct
+import collections
 
 
 class GpsPod:
-    def __init__(self, communicator, inter_packet_delay=0.01):
+    def __init__(self, communicator, inter_packet_delay=0.01,
+                 pipeline_depth=1):
         self.fs = bytearray(pmem.FILESYSTEM_SIZE)
-        self.retrieved_fs = bytearray(pmem.FILESYSTEM_SIZE)
+        # one marker per block, set when that block has been retrieved.
+        self.block_size = protocol.DataRequest.block_size
+        self.block_count = pmem.FILESYSTEM_SIZE // self.block_size
+        self.retrieved_blocks = bytearray(self.block_count)
         self.com = communicator
         self.memfs = None
         self.data = None
         self.inter_packet_delay = inter_packet_delay
+        # bounds for the delay between retries of a failed request, a transient
+        # failure is retried almost immediately.
+        self.min_retry_delay = min(inter_packet_delay, 0.001)
+        self.max_retry_delay = max(inter_packet_delay, 0.02)
+        # number of data requests that may be outstanding at the same time.
+        self.pipeline_depth = max(1, int(pipeline_depth))
+        # The data request is serialized when it is written, so one instance
+        # can be reused for all the blocks.
+        self.data_request = protocol.DataRequest()
 
         self.tracks = []
+        self.tracks_loaded = False
         self.debug_logs = []
 
-    def communicate(self, msg, expected_reply, retry_count=10):
+    def communicate(self, msg, expected_reply, retry_count=10, accept=None):
         error_count = 0
+        # Back off exponentially on failures, such that a busy device gets
+        # more time to recover. The delays are jittered so retries don't stay
+        # in step with whatever keeps the device busy.
+        # A reply of the wrong type means the device is responsive, the
+        # request is sent again right away. A reply of the right type that is
+        # rejected by accept is a late reply to an earlier request, the reply
+        # to this request may still follow it, so it is read without sending
+        # the request again.
+        delay = self.min_retry_delay
+        send = True
         while (error_count < retry_count):
             try:
-                self.com.write_msg(msg)
+                if (send):
+                    self.com.write_msg(msg)
                 ret_packet = self.com.read_msg()
-                if (type(ret_packet) == expected_reply):
-                    return ret_packet
-                else:
+                send = True
+                if (isinstance(ret_packet, expected_reply)):
+                    if ((accept is None) or accept(ret_packet)):
+                        return ret_packet
                     error_count += 1
-                time.sleep(self.inter_packet_delay)
+                    send = False
+                    continue
+                if (ret_packet is not None):
+                    error_count += 1
+                    continue
             except interact.CommunicatorError:
-                time.sleep(self.inter_packet_delay)
+                pass
+            error_count += 1
+            send = True
+            time.sleep(delay * (0.5 + random.random()))
+            delay = min(delay * 2, self.max_retry_delay)
         return False
 
     def transfer_block(self, block_index):
-        p = protocol.DataRequest()
-        p.pos(block_index * p.block_size)
-        ret_packet = self.communicate(p, protocol.DataReply)
+        p = self.data_request
+        position = block_index * p.block_size
+        p.pos(position)
+
+        def is_requested(reply):
+            if (reply.position() == position):
+                return True
+            # A late reply to an earlier request still holds valid data.
+            self.store_block(reply)
+            return False
+
+        # Up to pipeline_depth late replies may arrive before the right one.
+        ret_packet = self.communicate(p, protocol.DataReply,
+                                      retry_count=10 + self.pipeline_depth,
+                                      accept=is_requested)
         if (ret_packet):
-            # load the data
-            pos = ret_packet.position()
-            length = ret_packet.length()
-            self.fs[pos:pos+length] = ret_packet.content()
-            ones = bytes([1 for i in range(length)])
-            self.retrieved_fs[pos:pos+length] = bytes(ones)
+            self.store_block(ret_packet)
             return True
         else:
             print("Failed retrieving block: {:>0X}".format(block_index))
             return False
 
-    def have_data(self, key):
-        if (sum(self.retrieved_fs[key]) == (key.stop - key.start)):
+    def store_block(self, ret_packet):
+        # load the data
+        pos = ret_packet.position()
+        length = ret_packet.content_into(
+            memoryview(self.fs)[pos:pos+ret_packet.length()])
+        # Only mark the blocks that were retrieved completely.
+        first = -(-pos // self.block_size)
+        last = (pos + length) // self.block_size
+        if (last > first):
+            self.retrieved_blocks[first:last] = b"\x01" * (last - first)
+
+    def transfer_blocks(self, block_indices):
+        if (self.pipeline_depth == 1):
+            for i in block_indices:
+                if (not self.transfer_block(i)):
+                    return False
             return True
-        # otherwise, we have to get it.
-        block_size = protocol.DataRequest.block_size
-        block_start = int(key.start / block_size)
-        block_end = min(int((key.stop + block_size) / block_size),
-                        int(pmem.FILESYSTEM_SIZE/block_size))
 
-        for i in range(block_start, block_end):
+        # Keep up to pipeline_depth requests in flight, such that we do not
+        # wait for a full round trip for every block. The replies are matched
+        # to the requests by their position.
+        p = self.data_request
+        block_size = p.block_size
+        data_reply = protocol.DataReply
+        block_indices = list(block_indices)
+        queued = collections.deque(block_indices)
+        outstanding = {}
+        retry = []
+        while (queued or outstanding):
+            while (queued and (len(outstanding) < self.pipeline_depth)):
+                block_index = queued.popleft()
+                p.pos(block_index * block_size)
+                try:
+                    self.com.write_msg(p)
+                    outstanding[block_index * block_size] = block_index
+                except interact.CommunicatorError:
+                    retry.append(block_index)
+
+            if (not outstanding):
+                continue
+
+            try:
+                ret_packet = self.com.read_msg()
+            except interact.CommunicatorError:
+                ret_packet = None
+
+            if (isinstance(ret_packet, data_reply)):
+                # Even a reply we did not expect holds valid data.
+                self.store_block(ret_packet)
+                outstanding.pop(ret_packet.position(), None)
+            else:
+                # Lost track of the replies, retrieve the remaining requests
+                # one by one.
+                retry.extend(outstanding.values())
+                outstanding.clear()
+                time.sleep(self.inter_packet_delay)
+
+        # Replies to the abandoned requests may still arrive, transfer_block
+        # stores those and skips them when waiting for its own reply.
+        for i in sorted(retry):
+            if (self.retrieved_blocks[i]):
+                continue
             if (not self.transfer_block(i)):
                 return False
-        return True
+        return all(self.retrieved_blocks[i] for i in block_indices)
+
+    def missing_blocks(self, start, stop):
+        # Yields the indices of the blocks in [start, stop) that have not been
+        # retrieved yet, skipping over runs of retrieved blocks with find.
+        while (start < stop):
+            start = self.retrieved_blocks.find(0, start, stop)
+            if (start == -1):
+                return
+            run_end = self.retrieved_blocks.find(1, start, stop)
+            if (run_end == -1):
+                run_end = stop
+            yield from range(start, run_end)
+            start = run_end
+
+    def have_data(self, key):
+        block_size = self.block_size
+        block_count = self.block_count
+        # Only the blocks that overlap with the key, rounding the end up.
+        block_start = key.start // block_size
+        block_end = min(-(-key.stop // block_size), block_count)
+        # Searching for an unretrieved block doesn't copy the markers.
+        if (self.retrieved_blocks.find(0, block_start, block_end) == -1):
+            return True
+        # otherwise, we have to get it.
+
+        # Small sequential reads, like the entries of a track, only miss one
+        # block at a time. Read ahead such that the pipeline is filled with
+        # the blocks that follow and have not been retrieved yet. Blocks that
+        # were already retrieved are not requested again.
+        ahead_end = max(min(block_start + self.pipeline_depth, block_count),
+                        block_end)
+        self.transfer_blocks(list(self.missing_blocks(block_start, ahead_end)))
+        # Only the blocks of the key matter, a failed read-ahead does not.
+        return (self.retrieved_blocks.find(0, block_start, block_end) == -1)
 
     def __getitem__(self, key):
         if self.have_data(key):
@@ -93,17 +222,31 @@ class GpsPod:
             # TODO: Use a proper error?
             raise IndexError("Could not get data")
 
+    def view(self, key):
+        # Same as indexing, but returns a view on the data instead of a copy.
+        if self.have_data(key):
+            return memoryview(self.fs)[key]
+        else:
+            raise IndexError("Could not get data")
+
     def mount(self, fs=None):
         if (fs is None):
             self.memfs = pmem.MEMfs(self)
             self.data = pmem.BPMEMfile(self.memfs)
         else:
             # assume it is a complete filesystem.
-            self.retrieved_fs = bytes([1 for i in range(pmem.FILESYSTEM_SIZE)])
+            self.fs = fs
+            self.retrieved_blocks = b"\x01" * self.block_count
             self.memfs = pmem.MEMfs(fs)
             self.data = pmem.BPMEMfile(self.memfs)
 
     def load_tracks(self):
+        # Only the headers of the tracks are read here, the samples are read
+        # by load_entries on the tracks that are retrieved, listing the
+        # tracks does not touch the sample data.
+        # The logs are appended to when loading, only load them once.
+        if (self.tracks_loaded):
+            return
         self.data.tracks.load_block_header()
         self.data.tracks.load_logs()
         # print(" ".join([str(l) for l in self.data.tracks.logs]))
@@ -111,13 +254,10 @@ class GpsPod:
         for track in self.data.tracks.logs:
             if track.load_header():
                 self.tracks.append(track)
+        self.tracks_loaded = True
 
     def recovered_track(self):
-        self.data.tracks.load_block_header()
-        self.data.tracks.load_logs()
-        for track in self.data.tracks.logs:
-            if track.load_header():
-                self.tracks.append(track)
+        self.load_tracks()
 
         # the relevant data is ALWAYS after the last existing track.
         # we use this last track, we assume the recovered one is made using the
@@ -127,8 +267,8 @@ class GpsPod:
         rtrack = self.tracks[-1]  # recover track
         print("Retrieving track prior to the recoverables.")
         start_time = time.time()
-        track.load_entries()
-        samples = track.get_entries()
+        rtrack.load_entries()
+        samples = rtrack.get_entries()
         end_time = time.time()
         print("Track prior retrieved in {:.1f}s, with {} entries".format(
               end_time - start_time, len(samples)))
@@ -159,32 +299,51 @@ class GpsPod:
                 return True
             return False
 
+        # Number of consecutive valid entries starting at an offset, for the
+        # walks that ended in an invalid entry. Walks from different start
+        # offsets often end up at the same entries.
+        valid_entries = {}
+
         def check_packet_tail(rtrack, offset, to_check):
             """
                 This tries to read to_check entries from rtrack at offset.
-                interprets the entries and determines if they are valid. It
-                calls itself until to_check is equal to zero, at which point it
-                returns True.
+                interprets the entries and determines if they are valid.
                 Basically this checks if there are to_check valid entries after
                 offset.
             """
-            if (to_check == 0):
-                return True
-            len1, data1 = rtrack.peek_entry(offset)
-            # only bother if the type is < 256
-            if (0 <= len1 < 256):
+            visited = []
+            while (len(visited) < to_check):
+                if (offset in valid_entries):
+                    # Continues into a walk that was done before.
+                    count = valid_entries[offset]
+                    break
+                len1, data1 = rtrack.peek_entry(offset)
+                # only bother if the type is < 256
+                if (not (0 <= len1 < 256)):
+                    count = 0
+                    break
                 try:
                     entry1 = rtrack.process_entry(data1)
                 except struct.error as e:
-                    return False
-
+                    count = 0
+                    break
                 if not is_parsed_sane(entry1):
-                    return False
-                # All good, check if the remainder of packets to be checked is
-                # good as well.
-                return check_packet_tail(rtrack, offset + len1 + 2, to_check - 1)
+                    count = 0
+                    break
+                # All good, check if the next entry is good as well.
+                visited.append(offset)
+                offset += len1 + 2
             else:
-                return False
+                return True
+
+            if (len(visited) + count >= to_check):
+                return True
+            # Remember the walk, it ended in an invalid entry.
+            valid_entries[offset] = count
+            for visited_offset in reversed(visited):
+                count += 1
+                valid_entries[visited_offset] = count
+            return False
 
         found_offset = False
         print("Attempting to align to recoverable data.")
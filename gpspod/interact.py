@@ -26,11 +26,7 @@
 from . import protocol
 import sys
 import time
-
-# to export the communication
-import json
-import gzip
-import base64
+import binascii
 
 class CommunicatorError(BaseException):
     pass
@@ -170,11 +166,14 @@ class CommunicatorHIDAPI(BaseCommunicator):
         # timeout is in ms
         timeout = self.read_timeout
         try:
-            start_time = time.time()
+            end_time = time.time() + timeout/1000.0
             while ((len(self.read_buffer) <= self.usb_packetlength) and
-                    (start_time + timeout/1000.0 >= time.time())):
+                    (end_time >= time.time())):
                 # read is not guaranteed to give the desired number of bytes?
-                res = self.dev.read(self.usb_packetlength)
+                # Block in the read for the remaining time instead of polling,
+                # hidapi returns as soon as a report arrives.
+                remaining = max(1, int((end_time - time.time()) * 1000))
+                res = self.dev.read(self.usb_packetlength, remaining)
                 self.read_buffer += bytearray(res)
                 if (len(res) > self.read_sleep_minsize):
                     time.sleep(self.read_sleep_duration / 1000.0)
@@ -214,47 +213,68 @@ except ImportError as e:
 
 if ((not _found_hidapi) and (not _found_pyusb)):
     print("Nothing found to write to the USB devices, local only.")
+    # Keeps the recording communicator defined, it can't be used without USB.
+    Communicator = BaseCommunicator
 
 class RecordingCommunicator(Communicator):
-    def __init__(self, path=None, *args, **kwargs):
+    def __init__(self, path=None, *args, compresslevel=1, **kwargs):
         self.save_path = path
+        # The recorded packets are base64 encoded binary data, they barely
+        # compress better at higher levels, which are much slower.
+        self.compresslevel = compresslevel
         self.incoming_packets = []
         self.outgoing_packets = []
         super().__init__(*args, **kwargs)
 
+    # Packets are stored as their json entry, a timestamp and the base64
+    # encoded data, as they pass. This spreads the encoding over the session,
+    # writing the recording only joins the entries. The entries are formatted
+    # as json.dumps would write them.
     def write_packet(self, packet):
-        self.outgoing_packets.append((time.time(), bytes(packet)))
+        self.outgoing_packets.append("[{!r},\"{}\"]".format(
+            time.time(), binascii.b2a_base64(bytes(packet),
+                                             newline=False).decode("ascii")))
         return super().write_packet(packet)
 
     def read_packet(self):
         read_res = super().read_packet()
         if (read_res):
-            self.incoming_packets.append((time.time(), bytes(read_res)))
+            self.incoming_packets.append("[{!r},\"{}\"]".format(
+                time.time(), binascii.b2a_base64(
+                    bytes(read_res), newline=False).decode("ascii")))
         return read_res
 
+    def transactions_json(self):
+        return "".join(("{\"incoming\":[", ",".join(self.incoming_packets),
+                        "],\"outgoing\":[", ",".join(self.outgoing_packets),
+                        "]}"))
+
     def transactions(self):
-        incoming_processed = []
-        outgoing_processed = []
-        for t, v in self.incoming_packets:
-            incoming_processed.append((t, base64.b64encode(v).decode('ascii')))
-        for t, v in self.outgoing_packets:
-            outgoing_processed.append((t, base64.b64encode(v).decode('ascii')))
-        return {"incoming": incoming_processed, "outgoing": outgoing_processed}
+        import json
+        return json.loads(self.transactions_json())
 
     def write_json(self, path=None):
+        # to export the communication
+        import gzip
         if (path is None):
             path = self.save_path
         if (path is not None):
-            opener = gzip.open if path.endswith(".gz") else open
-            with opener(path, "wt") as f:
-                json.dump(self.transactions(), f)
+            data = self.transactions_json().encode("ascii")
+            if (path.endswith(".gz")):
+                f = gzip.open(path, "wb", compresslevel=self.compresslevel)
+            else:
+                f = open(path, "wb")
+            with f:
+                f.write(data)
 
     def __exit__(self, *args, **kwargs):
         self.write_json()
         return super().__exit__(*args, **kwargs)
 
 
-class OfflineCommunicator(Communicator):
+class OfflineCommunicator(BaseCommunicator):
+    # Plays back recorded transactions, it does not depend on or touch any USB
+    # backend.
     def __init__(self, entries={"outgoing": [], "incoming": []}):
         self.entries = entries
         self.incoming_counter = 0
@@ -282,10 +302,16 @@ class OfflineCommunicator(Communicator):
     def close(self):
         pass
 
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
 
 if __name__ == "__main__":
     req = protocol.DeviceInfoRequest()
     c = Communicator()
     c.connect()
     c.write_msg(req)
-    print("{:s}".format(c.read_msg()))
+    print(c.read_msg())
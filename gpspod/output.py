@@ -24,11 +24,41 @@
 
 from . import pmem
 import xml.etree.cElementTree as ET
-from xml.dom import minidom
+import itertools
 import datetime
 from math import pi
 
 
+def escape(data):
+    # The same escaping as minidom uses for text and attribute values.
+    return data.replace("&", "&amp;").replace("<", "&lt;").replace(
+        "\"", "&quot;").replace(">", "&gt;")
+
+
+def start_tag(el, indent):
+    # Namespace declarations are placed before other attributes, like minidom
+    # does.
+    attributes = sorted(el.attrib.items(),
+                        key=lambda x: not x[0].startswith("xmlns"))
+    return "".join([indent, "<", el.tag] + [' {}="{}"'.format(k, escape(v))
+                                            for k, v in attributes])
+
+
+def iter_element(el, indent):
+    # Yields the element tree in the same layout as minidom's toprettyxml
+    # with tabs.
+    start = start_tag(el, indent)
+    if (len(el)):
+        yield start + ">\n"
+        for child in el:
+            yield from iter_element(child, indent + "\t")
+        yield indent + "</" + el.tag + ">\n"
+    elif (el.text):
+        yield start + ">" + escape(el.text) + "</" + el.tag + ">\n"
+    else:
+        yield start + "/>\n"
+
+
 class GPSWriter:
     def __init__(self, logentries, metadata, lap_splits_segment=True,
                  lap_adds_wpt=True, write_points=True, time_local=False):
@@ -123,7 +153,34 @@ class GPSWriter:
                 second=time_spec["UTC"]["second"])
             self.time_suffix = "Z"
 
-    def create_xml(self):
+        # Date part of the timestamps, by the day relative to the base time.
+        self.date_prefixes = {}
+        self.base_seconds = (self.base_time.hour * 3600 +
+                             self.base_time.minute * 60 +
+                             self.base_time.second)
+
+    def format_time(self, seconds):
+        # Produces the same as isoformat() of the base time plus the relative
+        # time, but only creates a datetime once per day instead of per point.
+        microseconds = round(seconds * 1e6)
+        seconds, microseconds = divmod(microseconds, 1000000)
+        day, seconds = divmod(self.base_seconds + seconds, 86400)
+        prefix = self.date_prefixes.get(day)
+        if (prefix is None):
+            date = self.base_time.date() + datetime.timedelta(days=day)
+            prefix = date.isoformat() + "T"
+            self.date_prefixes[day] = prefix
+        hour, seconds = divmod(seconds, 3600)
+        minute, seconds = divmod(seconds, 60)
+        if (microseconds):
+            return "{}{:0>2d}:{:0>2d}:{:0>2d}.{:0>6d}{}".format(
+                prefix, hour, minute, seconds, microseconds, self.time_suffix)
+        return "{}{:0>2d}:{:0>2d}:{:0>2d}{}".format(prefix, hour, minute,
+                                                     seconds, self.time_suffix)
+
+    def create_tree(self):
+        # Creates the document without the track segments, these are
+        # produced by iter_track_points while writing.
         root = ET.Element("gpx")
         root.attrib["creator"] = "GPS Track Pod "\
             "(via https://github.com/iwanders/gps_track_pod)"
@@ -184,31 +241,89 @@ class GPSWriter:
         name_el = ET.SubElement(trk, "name")
         name_el.text = self.base_time.strftime("Track %Y-%m-%d %H:%M:%S")
 
+        return root, trk
+
+    def iter_track_points(self):
+        # Yields None when a new track segment starts, and the trkpt elements
+        # of the segment after that.
+        if (not self.write_points):
+            return
         previous_segment = None
-        if self.write_points:
-            trkseg = ET.SubElement(trk, "trkseg")
-            for seg in self.entries:
-                if (self.lap_splits_segment and "lap_indicator" in seg):
-                    trkseg = ET.SubElement(trk, "trkseg")
-                    if (previous_segment):
-                        trkpt = ET.SubElement(trkseg, "trkpt")
-                        self.populate_element(trkpt, previous_segment)
-                    continue
-
-                if ("latitude" not in seg) or ("longitude" not in seg) or (
-                                                            "time" not in seg):
-                    print("Skipping segment: {}".format(seg))
-                    continue
-
-                previous_segment = seg
-                trkpt = ET.SubElement(trkseg, "trkpt")
-                self.populate_element(trkpt, seg)
-
-        xmlstr = ET.tostring(root, encoding='utf-8', method='xml')
-        xmlstr_pretty = minidom.parseString(xmlstr).toprettyxml(
-                            encoding='utf-8')
-
-        return xmlstr_pretty
+        yield None
+        for seg in self.entries:
+            if (self.lap_splits_segment and "lap_indicator" in seg):
+                yield None
+                if (previous_segment):
+                    trkpt = ET.Element("trkpt")
+                    self.populate_element(trkpt, previous_segment)
+                    yield trkpt
+                continue
+
+            if ("latitude" not in seg) or ("longitude" not in seg) or (
+                                                        "time" not in seg):
+                print("Skipping segment: {}".format(seg))
+                continue
+
+            previous_segment = seg
+            trkpt = ET.Element("trkpt")
+            self.populate_element(trkpt, seg)
+            yield trkpt
+
+    def iter_track(self, trk, indent):
+        # Yields the track, the track points are created one at a time as
+        # they are written.
+        yield start_tag(trk, indent) + ">\n"
+        for child in trk:
+            yield from iter_element(child, indent + "\t")
+
+        segment_indent = indent + "\t"
+        in_segment = False
+        segment_empty = True
+        for trkpt in self.iter_track_points():
+            if (trkpt is None):
+                if (in_segment):
+                    yield segment_indent + ("<trkseg/>\n" if segment_empty
+                                            else "</trkseg>\n")
+                in_segment = True
+                segment_empty = True
+                continue
+            if (segment_empty):
+                yield segment_indent + "<trkseg>\n"
+                segment_empty = False
+            yield from iter_element(trkpt, segment_indent + "\t")
+        if (in_segment):
+            yield segment_indent + ("<trkseg/>\n" if segment_empty
+                                    else "</trkseg>\n")
+        yield indent + "</trk>\n"
+
+    def iter_xml(self):
+        # Yields the pretty printed gpx in pieces.
+        root, trk = self.create_tree()
+        yield '<?xml version="1.0" encoding="utf-8"?>\n'
+        yield start_tag(root, "") + ">\n"
+        for child in root:
+            if (child is trk):
+                yield from self.iter_track(trk, "\t")
+            else:
+                yield from iter_element(child, "\t")
+        yield "</gpx>\n"
+
+    def write_xml(self, f):
+        # Writes the pretty printed gpx to the binary file f, as it is
+        # produced, instead of creating the entire document in memory. The
+        # pieces are encoded in batches. Returns the number of bytes written.
+        written = 0
+        pieces = self.iter_xml()
+        while True:
+            batch = list(itertools.islice(pieces, 512))
+            if (not batch):
+                return written
+            data = "".join(batch).encode("utf-8")
+            f.write(data)
+            written += len(data)
+
+    def create_xml(self):
+        return "".join(self.iter_xml()).encode("utf-8")
 
     def populate_element(self, el, seg, name=None, comment=None,
                          added_extensions={}):
@@ -216,11 +331,8 @@ class GPSWriter:
         el.attrib["lat"] = "{:.7f}".format(seg["latitude"]["value"])
         el.attrib["lon"] = "{:.7f}".format(seg["longitude"]["value"])
 
-        relative_time = datetime.timedelta(seconds=seg["time"]["value"])
-        sample_time = self.base_time + relative_time
-
         time_el = ET.SubElement(el, "time")
-        time_el.text = sample_time.isoformat() + self.time_suffix
+        time_el.text = self.format_time(seg["time"]["value"])
 
         if "gpsaltitude" in seg:
             elevation = ET.SubElement(el, "ele")
@@ -660,6 +660,9 @@ class PMEMEntry(ctypes.LittleEndianStructure, Dictionary, Readable):
 
 
 class PMEMEntriesBlock():
+    # Compiled big endian formats used by parse, by their format string.
+    structs = {}
+
     def __init__(self, block, pos, log_header):
         self.block = block
         self.start_pos = pos
@@ -689,9 +692,13 @@ class PMEMEntriesBlock():
         
 
     def parse(self, format, buffer, offset=0):
-        res = list(struct.unpack_from(">"+format, buffer, offset))
+        parser = self.structs.get(format)
+        if (parser is None):
+            parser = struct.Struct(">" + format)
+            self.structs[format] = parser
+        res = list(parser.unpack_from(buffer, offset))
         # print(res)
-        res.append(offset + struct.calcsize(format))
+        res.append(offset + parser.size)
         # print(res)
         return res
 
@@ -875,8 +882,9 @@ class PMEMInternalLog(PMEMBlock):
 
 if __name__ == "__main__":
     import sys
+    import mmap
     with open(sys.argv[1], 'rb') as f:
-        fs_data = f.read()
+        fs_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
     m = MEMfs(fs_data)
     data = BPMEMfile(m)
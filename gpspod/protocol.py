@@ -82,6 +82,8 @@ class Dictionary:
 # Protocol specific parameters.
 #############################################################################
 
+# crcmod precomputes a 256 entry table for the polynomial and uses its C
+# extension when available, the CRC is table driven already.
 crc_proto = crcmod.mkCrcFun(poly=0x11021, initCrc=0xFFFF, rev=False, xorOut=0)
 USB_PACKET_SIZE = 64
 MAX_PACKET_SIZE = 540  # maximum protocol packet size. (Split over USBPackets)
@@ -93,6 +95,19 @@ USB_PACKET_MESSAGE_PART_NEXT = 0x5E
 # USB Packet handling.
 #############################################################################
 
+# The header checksum only covers the part, length and sequence fields, which
+# take few distinct values. Cache the checksums instead of recomputing them
+# for every packet.
+header_crcs = {}
+
+
+def header_crc(header_bytes):
+    crc = header_crcs.get(header_bytes)
+    if (crc is None):
+        crc = crc_proto(header_bytes)
+        header_crcs[header_bytes] = crc
+    return crc
+
 
 class USBPacketHeader(ctypes.LittleEndianStructure, Dictionary):
     _pack_ = 1
@@ -106,14 +121,14 @@ class USBPacketHeader(ctypes.LittleEndianStructure, Dictionary):
 
     def is_correct(self):
         header_bytes = bytes(self)[2:-2]
-        calc_crc = crc_proto(header_bytes)
+        calc_crc = header_crc(header_bytes)
         return (calc_crc == self.header_checksum) and \
                (self.usb_length == self.message_length + 8) and \
                (self.magic == 0x3f)
 
     def make_correct(self):
         header_bytes = bytes(self)[2:-2]
-        calc_crc = crc_proto(header_bytes)
+        calc_crc = header_crc(header_bytes)
         self.header_checksum = calc_crc
         self.magic = 0x3F
 
@@ -229,8 +244,10 @@ class USBPacketFeed:
             packet_data = []
             packet_data += self.first.data
             for i, j in self.packets:
-                if (j.data):
-                    packet_data += j.data
+                # data verifies the checksum, only retrieve it once.
+                data = j.data
+                if (data):
+                    packet_data += data
                 else:
                     print("Checksum failed, discarding data")
                     self.packets = []
@@ -705,6 +722,14 @@ class DataReply(Message):
 
     def content(self):
         return bytes(self.data_reply.data)
+
+    def content_into(self, dst):
+        # Copy the data straight into a writable buffer, without creating an
+        # intermediate bytes object. Returns the number of bytes copied.
+        length = min(self.data_reply.length, len(self.data_reply.data),
+                     len(dst))
+        dst[:length] = memoryview(self.data_reply.data).cast("B")[:length]
+        return length
 """
 The maximum position retrieved is 0x3BFE00, with size 0x0200 consistently.
 
@@ -784,17 +809,24 @@ class SetSettingsRequest(Message):
     direction_id = 0x0005
     body_field = "personal_settings"
 
-    def __new__(self):
-        b = "00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00"\
-            " 00 00 00 00 00 01 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00"\
-            " 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00"\
-            " 00 00 00 00 00 00 00"
-        byte_object = bytes([int(a, 16) for a in b.split(" ")])
-        a = super().__new__(self)
-        ctypes.memmove(ctypes.addressof(a.set_settings_request),
-                       bytes(byte_object), len(byte_object))
+    # Parsed once, copied into every new request.
+    default_body = bytes.fromhex(
+        "00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 "
+        "00 00 00 00 00 01 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 "
+        "00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 "
+        "00 00 00 00 00 00 00")
+
+    def __new__(cls, **kwargs):
+        a = super().__new__(cls)
+        ctypes.memmove(ctypes.addressof(a.personal_settings),
+                       cls.default_body, len(cls.default_body))
         return a
 
+    def __init__(self, sounds=None):
+        super().__init__()
+        if (sounds is not None):
+            self.sounds = sounds
+
     # Should equal 2 for off, 1 for on.
     @property
     def sounds(self):
@@ -873,28 +905,42 @@ class SetLogSettingsRequest(Message):
     # position in the filesystem. Combined with the fact that this one starts
     # with 0x00000000, 0x00000114 (276 = message length from 03)
     # From there on, so from 03 00 10 .. it aligns with the FS from 0x2000
-    def __new__(self):
-        b = "00 00 00 00 14 01 00 00 03 00 10 01 00 01 0C 01 0B 01 02 00"\
-            " 02 00 01 01 02 01 02 01 2A 00 47 50 53 20 54 72 61 63 6B 20"\
-            " 50 4F 44 00 00 00 01 00 00 00 02 00 01 00 01 00 00 00 00 00"\
-            " 00 00 00 00 00 00 00 00 01 00 00 00 05 01 D0 00 06 01 3C 00"\
-            " 07 01 02 00 11 01 08 01 08 00 09 01 04 00 00 00 08 00 08 01"\
-            " 08 00 09 01 04 00 01 00 08 00 08 01 1A 00 09 01 04 00 02 00"\
-            " 00 00 0A 01 02 00 10 00 0A 01 02 00 01 00 0A 01 02 00 FE FF"\
-            " 06 01 42 00 07 01 02 00 23 01 08 01 08 00 09 01 04 00 00 00"\
-            " 08 00 08 01 08 00 09 01 04 00 01 00 28 00 08 01 20 00 09 01"\
-            " 04 00 02 00 00 00 0A 01 02 00 10 00 0A 01 02 00 08 00 0A 01"\
-            " 02 00 01 00 0A 01 02 00 FE FF 06 01 3C 00 07 01 02 00 22 01"\
-            " 08 01 08 00 09 01 04 00 00 00 18 00 08 01 08 00 09 01 04 00"\
-            " 01 00 19 00 08 01 1A 00 09 01 04 00 02 00 00 00 0A 01 02 00"\
-            " 32 00 0A 01 02 00 1A 00 0A 01 02 00 10 00 06 01 06 00 07 01"\
-            " 02 00 50 01"
-        byte_object = bytes([int(a, 16) for a in b.split(" ")])
-        a = super().__new__(self)
+    default_body = bytes.fromhex(
+        "00 00 00 00 14 01 00 00 03 00 10 01 00 01 0C 01 0B 01 02 00 "
+        "02 00 01 01 02 01 02 01 2A 00 47 50 53 20 54 72 61 63 6B 20 "
+        "50 4F 44 00 00 00 01 00 00 00 02 00 01 00 01 00 00 00 00 00 "
+        "00 00 00 00 00 00 00 00 01 00 00 00 05 01 D0 00 06 01 3C 00 "
+        "07 01 02 00 11 01 08 01 08 00 09 01 04 00 00 00 08 00 08 01 "
+        "08 00 09 01 04 00 01 00 08 00 08 01 1A 00 09 01 04 00 02 00 "
+        "00 00 0A 01 02 00 10 00 0A 01 02 00 01 00 0A 01 02 00 FE FF "
+        "06 01 42 00 07 01 02 00 23 01 08 01 08 00 09 01 04 00 00 00 "
+        "08 00 08 01 08 00 09 01 04 00 01 00 28 00 08 01 20 00 09 01 "
+        "04 00 02 00 00 00 0A 01 02 00 10 00 0A 01 02 00 08 00 0A 01 "
+        "02 00 01 00 0A 01 02 00 FE FF 06 01 3C 00 07 01 02 00 22 01 "
+        "08 01 08 00 09 01 04 00 00 00 18 00 08 01 08 00 09 01 04 00 "
+        "01 00 19 00 08 01 1A 00 09 01 04 00 02 00 00 00 0A 01 02 00 "
+        "32 00 0A 01 02 00 1A 00 0A 01 02 00 10 00 06 01 06 00 07 01 "
+        "02 00 50 01")
+
+    def __new__(cls, **kwargs):
+        a = super().__new__(cls)
         ctypes.memmove(ctypes.addressof(a.set_settings_request),
-                       bytes(byte_object), len(byte_object))
+                       cls.default_body, len(cls.default_body))
         return a
 
+    def __init__(self, autostart=None, autolap=None, autosleep=None,
+                 interval=None):
+        super().__init__()
+        # Only the given settings are changed from the defaults.
+        if (autostart is not None):
+            self.autostart = autostart
+        if (autolap is not None):
+            self.autolap = autolap
+        if (autosleep is not None):
+            self.autosleep = autosleep
+        if (interval is not None):
+            self.interval = interval
+
     @property
     def autostart(self):
         return self.set_settings_request.autostart_ == 1
@@ -64,8 +64,7 @@ class USBPacket():
         "usb.endpoint_number": lambda x: int(x, 16),
         "usb.endpoint_number.direction": lambda x: int(x),
         "usb.endpoint_number.endpoint": lambda x: int(x),
-        "usb.capdata": lambda x: [
-                int(c, 16) for c in [x[i:i + 2] for i in range(0, len(x), 2)]],
+        "usb.capdata": lambda x: bytes.fromhex(x),
         "usb.bString": lambda z: "".join(
             [chr(int(c[2:4] + c[0:2], 16)) for c in
                 [z[i:i+4]for i in range(0, len(z), 4)]])